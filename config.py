@@ -1,14 +1,25 @@
 import os
-from dotenv import load_dotenv
+from functools import lru_cache
 
-load_dotenv()
+from dotenv import load_dotenv
 
 class Settings:
-    WANDB_API_KEY = os.getenv("WANDB_API_KEY")
-    WANDB_PROJECT = os.getenv("WANDB_PROJECT", "bobby-flai")
-    WANDB_ENTITY = os.getenv("WANDB_ENTITY")
+    def __init__(self):
+        self.WANDB_API_KEY = os.getenv("WANDB_API_KEY")
+        self.WANDB_PROJECT = os.getenv("WANDB_PROJECT", "bobby-flai")
+        self.WANDB_ENTITY = os.getenv("WANDB_ENTITY")
+        self.ENVIRONMENT = os.getenv("ENVIRONMENT", "development")
+        self.SERVICE_VERSION = os.getenv("SERVICE_VERSION", "1.0.0")
     
     class Config:
         case_sensitive = True
 
-settings = Settings()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Load .env and read the environment once, returning the shared settings."""
+    if not os.getenv("RUNNING_IN_DOCKER"):
+        print("RUNNING_IN_DOCKER IS NOT SET, loading .env file")
+        load_dotenv()
+    else:
+        print("RUNNING_IN_DOCKER IS SET, skipping .env file loading")
+    return Settings()
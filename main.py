@@ -1,61 +1,71 @@
 """FastAPI service for logging recipe generation traces to Weights & Biases."""
 
-import json
-import os
-import re
-from contextlib import asynccontextmanager
+import asyncio
+import logging
+from contextlib import asynccontextmanager, suppress
 from datetime import UTC, datetime
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar, Union
 
+import orjson
 import weave
-from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ValidationError
 
 import wandb
-from wandb_visualizations import update_visualizations
+from config import get_settings
+from wandb_visualizations import (
+    VALIDATION_FLUSH_INTERVAL_S,
+    finish_wandb,
+    flush_visualizations,
+    get_wandb_run,
+    init_wandb,
+    queue_visualizations,
+)
 
-current_time =datetime.now(UTC).isoformat()
-if not os.getenv("RUNNING_IN_DOCKER"):
-    print("RUNNING_IN_DOCKER IS NOT SET, loading .env file")
-    load_dotenv()
-else:
-    print("RUNNING_IN_DOCKER IS SET, skipping .env file loading")
+logger = logging.getLogger(__name__)
 
-WANDB_API_KEY = os.getenv("WANDB_API_KEY")
-if not WANDB_API_KEY:
+settings = get_settings()
+if not settings.WANDB_API_KEY:
     print("Warning: WANDB_API_KEY not found in environment.")
     # Potentially raise an error or exit if it's critical and missing
     # raise ValueError("WANDB_API_KEY must be set in the environment or .env file")
 
+async def flush_visualizations_periodically():
+    """Log partially filled validation batches so metrics never go stale."""
+    while True:
+        await asyncio.sleep(VALIDATION_FLUSH_INTERVAL_S)
+        try:
+            await asyncio.to_thread(flush_visualizations)
+        except Exception:
+            logger.exception("Error flushing validation visualizations")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # W&B and Weave initialization block on network I/O, so keep it off the event loop
+    await asyncio.to_thread(
+        weave.init,
+        "bobby-flAI",
+        global_attributes= {
+            "environment": settings.ENVIRONMENT,
+            "service_version": settings.SERVICE_VERSION,
+            "model_defaults_temperature": 0.7,
+            "model_defaults_max_tokens": 2000
+        }
+    )
+    await asyncio.to_thread(init_wandb)
+    flusher = asyncio.create_task(flush_visualizations_periodically())
     yield
     print("Shutting down...")
+    flusher.cancel()
+    with suppress(asyncio.CancelledError):
+        await flusher
+    flush_visualizations()
     weave.finish()
+    finish_wandb()
 
-app = FastAPI(lifespan=lifespan)
-weave.init(
-    "bobby-flAI",
-    global_attributes= {
-        "environment": os.getenv("ENVIRONMENT", "development"),
-        "service_version": os.getenv("SERVICE_VERSION", "1.0.0"),
-        "model_defaults_temperature": 0.7,
-        "model_defaults_max_tokens": 2000
-    }
-)
-wandb.init(
-    project="bobby-flAI",
-    config={
-        "environment": os.getenv("ENVIRONMENT", "development"),
-        "service_version": os.getenv("SERVICE_VERSION", "1.0.0"),
-        "model_defaults": {
-            "temperature": 0.7,
-            "max_tokens": 2000
-        }
-    },
-    tags=["recipe-generation", os.getenv("ENVIRONMENT", "development")]
-)
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 class AutoEvaluation(BaseModel):
     grammar: Optional[Dict[str, Union[float, List[str]]]] = None
@@ -93,182 +103,240 @@ class JSONValidationRequest(BaseModel):
     traceId: str
     metadata: Dict[str, Any]
 
-def normalize_json(content: str) -> str:
-    """Normalize JSON formatting to ensure consistent structure."""
+# RecipeTrace fields logged as metrics, keyed by field name
+TRACE_METRIC_FIELDS = {
+    "responseTimeMs": "response_time_ms",
+    "promptTokens": "prompt_tokens",
+    "completionTokens": "completion_tokens",
+    "totalTokens": "total_tokens",
+    "retryCount": "retry_count",
+    "rating": "rating",
+    "temperature": "temperature",
+}
+TRACE_METRIC_INCLUDE = set(TRACE_METRIC_FIELDS)
+
+# error_type recorded for failed checks; kept as ValueError, the type the checks
+# used to raise, so the error_types/ValueError metric stays continuous
+VALIDATION_ERROR_TYPE = "ValueError"
+
+# Common GPT formatting issues
+# A fence followed by a raw newline; valid JSON strings cannot contain one
+MARKDOWN_MARKERS = ("```json\n", "```\n")
+
+INTRO_PREFIXES = (
+    "Here's",
+    "I'll",
+    "Let me",
+    "Here are",
+    "The recipes",
+    "Based on",
+    "Here is",
+    "I've",
+    "I have",
+    "Here",
+    "I",
+)
+
+REQUIRED_RECIPE_FIELDS = frozenset(
+    {'name', 'prepTime', 'cookTime', 'totalTime', 'ingredients', 'steps'}
+)
+
+def dump_json(value: Any) -> str:
+    """Serialize value as JSON, falling back to str() for values orjson rejects."""
     try:
-        # Parse and re-stringify to normalize formatting
-        data = json.loads(content)
-        return json.dumps(data, indent=2)
-    except json.JSONDecodeError:
-        # If parsing fails, return original content
-        return content
+        return orjson.dumps(value).decode()
+    except orjson.JSONEncodeError:
+        # e.g. integers wider than 64 bits, which still pass Dict[str, Any]
+        return str(value)
 
-@weave.op(name="validate-json")
-@app.post("/validate-json")
-async def validate_json(request: JSONValidationRequest):
-    start_time = datetime.now(UTC)
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+async def parse_body(raw_request: Request, model: Type[ModelT]) -> ModelT:
+    """Parse and validate the raw request body in a single pydantic-core pass."""
     try:
-        # Basic format validation
-        content = normalize_json(request.content.strip())
-        validation_steps = {
-            "array_format": False,
-            "markdown_removed": False,
-            "intro_text_removed": False,
-            "json_parsed": False,
-            "structure_validated": False
+        return model.model_validate_json(await raw_request.body())
+    except ValidationError as e:
+        # Match FastAPI's own body errors, which are located under "body"
+        errors = [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        raise RequestValidationError(errors) from e
+
+def _inline_schema_refs(node: Any, defs: Dict[str, Any]) -> Any:
+    """Replace local $defs references so the schema can be embedded on its own."""
+    if isinstance(node, dict):
+        if "$ref" in node:
+            return _inline_schema_refs(defs[node["$ref"].rsplit("/", 1)[-1]], defs)
+        return {key: _inline_schema_refs(value, defs) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_inline_schema_refs(value, defs) for value in node]
+    return node
+
+def request_body_openapi(model: Type[BaseModel]) -> Dict[str, Any]:
+    """Document a body read by parse_body, since FastAPI no longer sees the model."""
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": _inline_schema_refs(schema, defs)}},
         }
-        
-        # Track array format validation
-        if not content.startswith('[') or not content.endswith(']'):
-            print(f"Array format validation failed. Content starts with: {content[:10]}... and ends with: ...{content[-10:]}")
-            raise ValueError("Response must be a JSON array (starts with [ and ends with ])")
-        validation_steps["array_format"] = True
-        print("Array format validation passed")
-
-        # Check for common GPT formatting issues
-        markdown_patterns = [
-            (r'```json\n', "Response contains markdown code block"),
-            (r'```\n', "Response contains markdown code block"),
-        ]
-        
-        intro_patterns = [
-            (r'^Here\'s', "Response contains introductory text"),
-            (r'^I\'ll', "Response contains introductory text"),
-            (r'^Let me', "Response contains introductory text"),
-            (r'^Here are', "Response contains introductory text"),
-            (r'^The recipes', "Response contains introductory text"),
-            (r'^Based on', "Response contains introductory text"),
-            (r'^Here is', "Response contains introductory text"),
-            (r'^I\'ve', "Response contains introductory text"),
-            (r'^I have', "Response contains introductory text"),
-            (r'^Here', "Response contains introductory text"),
-            (r'^I', "Response contains introductory text"),
-        ]
-
-        # Track markdown removal
-        for pattern, message in markdown_patterns:
-            if re.search(pattern, content):
-                print(f"Markdown validation failed. Found pattern: {pattern}")
-                raise ValueError(f"Invalid response format: {message}")
-        validation_steps["markdown_removed"] = True
-        print("Markdown validation passed")
-
-        # Track intro text removal
-        for pattern, message in intro_patterns:
-            if re.search(pattern, content):
-                print(f"Intro text validation failed. Found pattern: {pattern}")
-                raise ValueError(f"Invalid response format: {message}")
-        validation_steps["intro_text_removed"] = True
-        print("Intro text validation passed")
-
-        # Parse and validate structure
-        try:
-            data = json.loads(content)
-            validation_steps["json_parsed"] = True
-            print("JSON parsing passed")
-            
-            if not isinstance(data, list):
-                print(f"Structure validation failed. Expected list, got {type(data)}")
-                raise ValueError("Response must be a JSON array")
-            if len(data) == 0:
-                print("Structure validation failed. Array is empty")
-                raise ValueError("Response array cannot be empty")
-
-            # Validate first recipe
-            first_recipe = data[0]
-            required_fields = ['name', 'prepTime', 'cookTime', 'totalTime', 'ingredients', 'steps']
-            missing_fields = [field for field in required_fields if field not in first_recipe]
-            if missing_fields:
-                print(f"Structure validation failed. Missing fields: {missing_fields}")
-                print(f"Available fields: {list(first_recipe.keys())}")
-                raise ValueError(f"Missing required fields in recipe: {', '.join(missing_fields)}")
-            
-            validation_steps["structure_validated"] = True
-            print("Structure validation passed")
-
-            # Calculate validation duration
-            validation_duration = int((datetime.now(UTC) - start_time).total_seconds() * 1000)
-
-            # Prepare validation data for visualization
-            validation_data = {
-                "success": True,
-                "validation_steps": validation_steps,
-                "validation_duration_ms": validation_duration,
-                "content_length": len(content),
-                "recipe_count": len(data),
-                "timestamp": current_time,
-                "session_id": request.sessionId,
-                "trace_id": request.traceId
-            }
+    }
+
+def check_array_format(content: str) -> Optional[str]:
+    """Check that the response is wrapped in array brackets."""
+    if not content.startswith('[') or not content.endswith(']'):
+        logger.warning("Array format validation failed. Content starts with: %s... and ends with: ...%s", content[:10], content[-10:])
+        return "Response must be a JSON array (starts with [ and ends with ])"
+    return None
+
+def check_markdown_removed(content: str) -> Optional[str]:
+    """Check that the response has no markdown code fences."""
+    for marker in MARKDOWN_MARKERS:
+        if marker in content:
+            logger.warning("Markdown validation failed. Found marker: %r", marker)
+            return "Invalid response format: Response contains markdown code block"
+    return None
+
+def check_intro_text_removed(content: str) -> Optional[str]:
+    """Check that the response does not open with introductory text."""
+    if content.startswith(INTRO_PREFIXES):
+        logger.warning("Intro text validation failed. Content starts with: %s...", content[:20])
+        return "Invalid response format: Response contains introductory text"
+    return None
+
+def check_json_parsed(content: str) -> Tuple[Any, Optional[str]]:
+    """Parse the response, logging the lines around any error."""
+    try:
+        return orjson.loads(content), None
+    except orjson.JSONDecodeError as e:
+        logger.warning("JSON parsing failed. Error: %s", e)
+        logger.warning("Error location: line %d, column %d", e.lineno, e.colno)
+        logger.warning("Error message: %s", e.msg)
+        # Log the content around the error
+        lines = content.split('\n')
+        if e.lineno > 1:
+            logger.warning("Line %d: %s", e.lineno - 1, lines[e.lineno - 2])
+        logger.warning("Line %d: %s", e.lineno, lines[e.lineno - 1])
+        if e.lineno < len(lines):
+            logger.warning("Line %d: %s", e.lineno + 1, lines[e.lineno])
+        return None, f"Invalid JSON format: {str(e)}"
+
+def check_structure_validated(data: Any) -> Optional[str]:
+    """Check that the response is a non-empty array whose first recipe has the required fields."""
+    if not isinstance(data, list):
+        logger.warning("Structure validation failed. Expected list, got %s", type(data))
+        return "Response must be a JSON array"
+    if len(data) == 0:
+        logger.warning("Structure validation failed. Array is empty")
+        return "Response array cannot be empty"
+
+    # Validate first recipe
+    first_recipe = data[0]
+    # A recipe that is not an object has none of the required fields
+    available_fields = first_recipe.keys() if isinstance(first_recipe, dict) else ()
+    missing_fields = sorted(REQUIRED_RECIPE_FIELDS.difference(available_fields))
+    if missing_fields:
+        logger.warning("Structure validation failed. Missing fields: %s", missing_fields)
+        logger.warning("Available fields: %s", list(available_fields))
+        return f"Missing required fields in recipe: {', '.join(missing_fields)}"
+    return None
+
+class ValidationState:
+    """Content being validated, plus the data once the parse step has run."""
+
+    def __init__(self, content: str):
+        self.content = content
+        self.data: Any = None
 
-            # Update visualizations
-            update_visualizations([validation_data])
+def parse_step(state: ValidationState) -> Optional[str]:
+    """Run the JSON parse as a chain step, keeping the data for later checks."""
+    state.data, error_message = check_json_parsed(state.content)
+    return error_message
 
-            return {"status": "success", "message": "JSON validation passed"}
+# Validation steps in order, cheapest first; the first check to return an
+# error ends validation, so the JSON is only parsed once the text checks pass
+VALIDATION_CHECKS = (
+    ("array_format", lambda state: check_array_format(state.content)),
+    ("markdown_removed", lambda state: check_markdown_removed(state.content)),
+    ("intro_text_removed", lambda state: check_intro_text_removed(state.content)),
+    ("json_parsed", parse_step),
+    ("structure_validated", lambda state: check_structure_validated(state.data)),
+)
 
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing failed. Error: {str(e)}")
-            print(f"Error location: line {e.lineno}, column {e.colno}")
-            print(f"Error message: {e.msg}")
-            # Print the content around the error
-            lines = content.split('\n')
-            if e.lineno > 1:
-                print(f"Line {e.lineno-1}: {lines[e.lineno-2]}")
-            print(f"Line {e.lineno}: {lines[e.lineno-1]}")
-            if e.lineno < len(lines):
-                print(f"Line {e.lineno+1}: {lines[e.lineno]}")
-            raise ValueError(f"Invalid JSON format: {str(e)}")
+VALIDATION_STEPS = tuple(step for step, _ in VALIDATION_CHECKS)
+INITIAL_VALIDATION_STEPS = dict.fromkeys(VALIDATION_STEPS, False)
 
+@weave.op(name="validate-json")
+@app.post("/validate-json", openapi_extra=request_body_openapi(JSONValidationRequest))
+async def validate_json(raw_request: Request, background_tasks: BackgroundTasks):
+    request = await parse_body(raw_request, JSONValidationRequest)
+    start_time = datetime.now(UTC)
+    state = ValidationState(request.content.strip())
+    validation_steps = INITIAL_VALIDATION_STEPS.copy()
+    error_message = None
+    error_type = VALIDATION_ERROR_TYPE
+    try:
+        for step, check in VALIDATION_CHECKS:
+            error_message = check(state)
+            if error_message is not None:
+                break
+            validation_steps[step] = True
+            logger.debug("Validation step %s passed", step)
     except Exception as e:
-        # Calculate validation duration
-        validation_duration = int((datetime.now(UTC) - start_time).total_seconds() * 1000)
-        
-        # Prepare error data for visualization
-        validation_data = {
-            "success": False,
-            "validation_steps": validation_steps,
-            "validation_duration_ms": validation_duration,
-            "content_length": len(request.content),
-            "error_type": type(e).__name__,
-            "error_message": str(e),
-            "timestamp": current_time,
-            "session_id": request.sessionId,
-            "trace_id": request.traceId
-        }
+        # Unexpected failures are still reported as validation errors
+        error_message = str(e)
+        error_type = type(e).__name__
 
-        # Update visualizations with error data
-        update_visualizations([validation_data])
-        
-        raise HTTPException(status_code=400, detail=str(e))
+    # Prepare validation data for visualization
+    validation_data = {
+        "success": error_message is None,
+        "validation_steps": validation_steps,
+        "validation_duration_ms": int((datetime.now(UTC) - start_time).total_seconds() * 1000),
+        "content_length": len(state.content),
+        "timestamp": start_time.isoformat(),
+        "session_id": request.sessionId,
+        "trace_id": request.traceId
+    }
+    if error_message is None:
+        validation_data["recipe_count"] = len(state.data)
+    else:
+        validation_data["error_type"] = error_type
+        validation_data["error_message"] = error_message
+
+    # Queue visualization data after the response has been sent
+    background_tasks.add_task(queue_visualizations, [validation_data])
+
+    if error_message is not None:
+        # Raising HTTPException would drop background tasks, so return the 400 directly
+        return ORJSONResponse(
+            status_code=400, content={"detail": error_message}, background=background_tasks
+        )
+    return {"status": "success", "message": "JSON validation passed"}
     
 @weave.op(name="log-trace")
-@app.post("/log-trace")
-async def log_trace(trace: RecipeTrace):
+@app.post("/log-trace", openapi_extra=request_body_openapi(RecipeTrace))
+async def log_trace(raw_request: Request):
+    trace = await parse_body(raw_request, RecipeTrace)
+    timestamp = datetime.now(UTC).isoformat()
     try:
         if trace.responseTimeMs < 0 or trace.responseTimeMs > 300000:
             raise ValueError(f"Invalid response time: {trace.responseTimeMs}ms")
         metrics = {
-            "response_time_ms": trace.responseTimeMs,
-            "prompt_tokens": trace.promptTokens,
-            "completion_tokens": trace.completionTokens,
-            "total_tokens": trace.totalTokens,
-            "retry_count": trace.retryCount,
-            "rating": trace.rating,
-            "temperature": trace.temperature,
-            "prompt_length": len(trace.prompt),
-            "response_length": len(trace.response),
-            "has_error": len(trace.errorTags) > 0,
+            TRACE_METRIC_FIELDS[field]: value
+            for field, value in trace.model_dump(
+                include=TRACE_METRIC_INCLUDE, exclude_none=True
+            ).items()
         }
-
-        metrics = {k: v for k, v in metrics.items() if v is not None}
+        metrics["prompt_length"] = len(trace.prompt)
+        metrics["response_length"] = len(trace.response)
+        metrics["has_error"] = len(trace.errorTags) > 0
 
         artifacts = {
             "prompt": trace.prompt,
             "response": trace.response,
             "postprocessed": trace.postprocessed,
-            "metadata": str(trace.metadata) if trace.metadata else None,
-            "auto_eval": str(trace.autoEval.model_dump()) if trace.autoEval else None,
-            "response_type": str(trace.responseType) if trace.responseType else None
+            "metadata": dump_json(trace.metadata) if trace.metadata else None,
+            "auto_eval": trace.autoEval.model_dump_json(exclude_unset=True) if trace.autoEval else None,
+            "response_type": dump_json(trace.responseType) if trace.responseType else None
         }
 
         metadata = {
@@ -289,22 +357,22 @@ async def log_trace(trace: RecipeTrace):
         if trace.metadata:
             metadata.update(trace.metadata)
         
-        wandb.log({
+        get_wandb_run().log({
             "metrics": metrics,
             "artifacts": wandb.Table(
                 columns=["category", "value"],
                 data=[
-                    [cat, str(v)] 
+                    [cat, v] 
                     for cat, v in artifacts.items() 
                     if v is not None
                 ]
             ),
             "metadata": metadata,
-            "timestamp": current_time,
+            "timestamp": timestamp,
             "session_group": trace.sessionId,
         })
 
-        return {"status": "success", "timestamp": current_time}
+        return {"status": "success", "timestamp": timestamp}
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve)) from ve
     except Exception as e:
@@ -312,7 +380,7 @@ async def log_trace(trace: RecipeTrace):
         print(f"Error type: {type(e).__name__}")
         import traceback
         print(f"Traceback: {traceback.format_exc()}")
-        wandb.log({
+        get_wandb_run().log({
             "error": {
                 "type": type(e).__name__,
                 "message": str(e),
@@ -329,11 +397,11 @@ async def health_check():
         return {
             "status": "healthy",
             "weave_project": weave.get_project(),
-            "weave_entity": os.getenv("WANDB_ENTITY", "default")
+            "weave_entity": settings.WANDB_ENTITY or "default"
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
     
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
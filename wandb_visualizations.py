@@ -1,51 +1,115 @@
+import statistics
+import threading
 import time
-from datetime import UTC, datetime, timedelta
-
-import pandas as pd
+from collections import Counter
+from datetime import UTC, datetime
 
 import wandb
+from config import get_settings
 
-# Initialize W&B run at module level
-wandb.init(
-    project="bobby-flAI",
-    name="validation-metrics",
-    job_type="validation",
-    config={
-        "environment": "production",
-        "service_version": "1.0.0"
-    }
-)
+settings = get_settings()
+
+_wandb_run = None
+
+def init_wandb():
+    """Initialize the shared W&B run, reusing an active run if there is one"""
+    global _wandb_run
+    if _wandb_run is None:
+        if wandb.run is not None:
+            _wandb_run = wandb.run
+        else:
+            _wandb_run = wandb.init(
+                project="bobby-flAI",
+                config={
+                    "environment": settings.ENVIRONMENT,
+                    "service_version": settings.SERVICE_VERSION,
+                    "model_defaults": {
+                        "temperature": 0.7,
+                        "max_tokens": 2000
+                    }
+                },
+                tags=["recipe-generation", settings.ENVIRONMENT]
+            )
+    return _wandb_run
+
+def get_wandb_run():
+    """Return the shared W&B run, initializing it on first use"""
+    if _wandb_run is None:
+        return init_wandb()
+    return _wandb_run
+
+def finish_wandb():
+    """Finish the shared W&B run so a later init starts a fresh one"""
+    global _wandb_run
+    if _wandb_run is not None:
+        _wandb_run.finish()
+        _wandb_run = None
+
+# Validation records are buffered and logged to W&B in batches
+VALIDATION_BATCH_SIZE = 20
+VALIDATION_FLUSH_INTERVAL_S = 5.0
+
+_pending_validations = []
+_pending_lock = threading.Lock()
+
+def _take_pending(min_size):
+    """Swap out the pending buffer if it holds at least min_size records"""
+    global _pending_validations
+    with _pending_lock:
+        if not _pending_validations or len(_pending_validations) < min_size:
+            return None
+        batch, _pending_validations = _pending_validations, []
+    return batch
+
+def queue_visualizations(validation_data):
+    """Buffer validation data, logging it once a full batch has accumulated"""
+    with _pending_lock:
+        _pending_validations.extend(validation_data)
+    batch = _take_pending(VALIDATION_BATCH_SIZE)
+    if batch:
+        update_visualizations(batch)
+
+def flush_visualizations():
+    """Log any buffered validation data regardless of batch size"""
+    batch = _take_pending(1)
+    if batch:
+        update_visualizations(batch)
+
+def percentile(values, q):
+    """Linearly interpolated percentile of values, matching pandas' quantile"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
 
 def update_visualizations(validation_data):
     """Update W&B visualizations with new validation data"""
     
-    # Convert validation data to pandas DataFrame
-    df = pd.DataFrame(validation_data)
-    print("DataFrame shape:", df.shape)
-    print(df)
+    record_count = len(validation_data)
+    print("Validation records:", record_count)
     
     # Calculate success rate
-    success_rate = df['success'].mean()
+    success_rate = sum(1 for d in validation_data if d['success']) / record_count
     print("Success rate:", success_rate)
     
     # Calculate validation step success rates
+    # Every record carries the full step map, in validation order
     step_success_rates = {
-        step: df['validation_steps'].apply(lambda x: x.get(step,False)).mean()
-        for step in ['array_format', 'markdown_removed', 'intro_text_removed', 'json_parsed', 'structure_validated']
+        step: sum(d['validation_steps'].get(step, False) for d in validation_data) / record_count
+        for step in validation_data[0]['validation_steps']
     }
     print("Step success rates:", step_success_rates)
     
     # Prepare error data
-    error_data = df[df['success'] == False]
-    error_types = {}
-    if not error_data.empty:
-        error_types = error_data['error_type'].value_counts().to_dict()
+    error_types = dict(Counter(d['error_type'] for d in validation_data if not d['success']))
     
     # Log metrics to existing tables
+    durations = [d['validation_duration_ms'] for d in validation_data]
     metrics_to_log = {
         "validation_success_rate": success_rate,
-        "validation_duration/mean_ms": df['validation_duration_ms'].mean(),
-        "validation_duration/p95_ms": df['validation_duration_ms'].quantile(0.95),
+        "validation_duration/mean_ms": statistics.mean(durations),
+        "validation_duration/p95_ms": percentile(durations, 0.95),
     }
     if error_types:
         for error_type, count in error_types.items():
@@ -59,7 +123,7 @@ def update_visualizations(validation_data):
         data=[[step.replace('_', ' ').title(), rate] for step, rate in step_success_rates.items()],
         columns=["Step", "Success Rate"]
     )   
-    scatter_data = df[['content_length', 'validation_duration_ms']].values.tolist()
+    scatter_data = [[d['content_length'], d['validation_duration_ms']] for d in validation_data]
     duration_scatter_table = wandb.Table(
         data=scatter_data,
         columns=["Content Length", "Duration (ms)"]
@@ -67,11 +131,18 @@ def update_visualizations(validation_data):
     
     # Create a table for validation metadata
     metadata_table = wandb.Table(
-        data=[[row['session_id'], row['trace_id'], row['timestamp']] for _, row in df.iterrows()],
+        data=[[d['session_id'], d['trace_id'], d['timestamp']] for d in validation_data],
         columns=["Session ID", "Trace ID", "Timestamp"]
     )
     
-    wandb.log({
+    # Raw records, with columns in first-seen key order
+    raw_columns = list(dict.fromkeys(key for d in validation_data for key in d))
+    raw_data_table = wandb.Table(
+        data=[[d.get(column) for column in raw_columns] for d in validation_data],
+        columns=raw_columns
+    )
+    
+    get_wandb_run().log({
         **metrics_to_log,
         "validation_steps_bar_chart": wandb.plot.bar(
             table=step_success_table,
@@ -95,7 +166,7 @@ def update_visualizations(validation_data):
             title="Validation Error Types"
         ),
         "validation_metadata": metadata_table,
-        "validation_raw_data_table": wandb.Table(dataframe=df)
+        "validation_raw_data_table": raw_data_table
     })
     print("Logged metrics to W&B tables")
 
@@ -203,4 +274,4 @@ def test_visualization_logging():
 if __name__ == "__main__":
     
     test_visualization_logging() 
-    wandb.finish()
\ No newline at end of file
+    finish_wandb()
\ No newline at end of file